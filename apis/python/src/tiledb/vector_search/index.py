@@ -184,6 +184,11 @@ class Index:
                 f"A query in queries has {query_dimensions} dimensions, but the indexed data had {self.dimensions} dimensions"
             )
 
+        # Convert the queries to C-contiguous float32 once, copying only if needed, so
+        # that both the updates query and `query_internal` can use them directly.
+        if queries.dtype != np.float32 or not queries.flags["C_CONTIGUOUS"]:
+            queries = np.ascontiguousarray(queries, dtype=np.float32)
+
         with tiledb.scope_ctx(ctx_or_config=self.config):
             if not self.has_updates:
                 if self.query_base_array:
@@ -16,16 +16,19 @@ IVFFlatIndex provides a vector search implementation that can trade-off accuracy
 Queries can be run in multiple modes:
 
 - Local main memory:
-  - Loads the entire index in memory during initialization and uses it to answer queries.
+  - Loads the entire index in memory on the first query and uses it to answer queries.
 - Local out of core:
   - Avoids loading index data in memory by interleaving I/O and query execution, respecting the
   memory budget defined by the user.
 - Distributed execution:
   - Executes the queries using multiple workers in TileDB Cloud.
 """
+import concurrent.futures as futures
 import json
 import multiprocessing
-from typing import Any, Mapping
+import uuid
+import warnings
+from typing import Any, List, Mapping, Tuple, Union
 
 import numpy as np
 
@@ -41,7 +44,19 @@ from tiledb.vector_search.utils import MAX_UINT64
 from tiledb.vector_search.utils import add_to_group
 
 TILE_SIZE_BYTES = 64000000  # 64MB
+# Minimum work, in query-vector distance computations, assigned to each node of a
+# taskgraph query. Queries with less work run on fewer nodes.
+MIN_NODE_WORK = 10000000
+# In BATCH/REALTIME mode, query batches whose partitioning computes more than this
+# many centroid distance terms (nqueries * partitions * dimensions) are partitioned
+# on a taskgraph worker, instead of on the client.
+REMOTE_PARTITIONING_MIN_WORK = 1000000000
+# Queries larger than this are written to a scratch array read by the taskgraph
+# workers, instead of being serialized into every node, if a `scratch_uri` is given.
+QUERIES_ARRAY_MIN_BYTES = 1000000  # 1MB
 INDEX_TYPE = "IVF_FLAT"
+# Order in which the results of taskgraph nodes are merged.
+_completion_order = futures.as_completed
 
 
 def submit_local(d, func, *args, **kwargs):
@@ -52,6 +67,163 @@ def submit_local(d, func, *args, **kwargs):
     return d.submit_local(func, *args, **kwargs)
 
 
+def to_column_major(queries: np.ndarray) -> np.ndarray:
+    """
+    Returns the (dimensions, nqueries) column-major view of a batch of queries.
+
+    The transpose of a row-major batch is already column-major, in which case no
+    copy is made and `array_to_matrix` can read the buffer directly.
+    """
+    queries_t = np.transpose(queries)
+    if not queries_t.flags.f_contiguous:
+        queries_t = queries_t.copy(order="F")
+    return queries_t
+
+
+def merge_top_k(results_d: np.ndarray, results_i: np.ndarray, k: int):
+    """
+    Merges per-node top-k candidates into the final top-k results of each query.
+
+    Parameters
+    ----------
+    results_d: np.ndarray
+        (nqueries, n) array of candidate distances. Distances <= 0 mark empty slots.
+    results_i: np.ndarray
+        (nqueries, n) array of candidate ids, with n >= k.
+    k: int
+        Number of results to return per query.
+
+    Returns sorted (nqueries, k) distances and ids. Queries with fewer than `k`
+    candidates are padded with (0.0, 0).
+    """
+    results_d = np.where(results_d > 0, results_d, np.inf)
+    top_k = np.argpartition(results_d, min(k, results_d.shape[1]) - 1, axis=1)[:, :k]
+    results_d = np.take_along_axis(results_d, top_k, axis=1)
+    results_i = np.take_along_axis(results_i, top_k, axis=1)
+    sort_index = np.argsort(results_d, axis=1)
+    results_d = np.take_along_axis(results_d, sort_index, axis=1)
+    results_i = np.take_along_axis(results_i, sort_index, axis=1)
+
+    missing = np.isinf(results_d)
+    results_d[missing] = 0.0
+    results_i[missing] = 0
+    return results_d, results_i
+
+
+def cumulative_partition_work(
+    active_partitions: np.ndarray,
+    active_queries: List[List[int]],
+    indices: np.ndarray,
+) -> np.ndarray:
+    """
+    Returns the running total of the work over the active partitions, measured as
+    the number of query-vector distances to compute.
+
+    Element `p` is the work of the first `p + 1` active partitions, so the last
+    element is the total work.
+
+    Parameters
+    ----------
+    active_partitions: np.ndarray
+        Ids of the partitions probed by at least one query.
+    active_queries: List[List[int]]
+        Ids of the queries probing each of the active partitions.
+    indices: np.ndarray
+        Partition index, with partition `p` spanning `[indices[p], indices[p + 1])`.
+    """
+    # Only gather the bounds of the active partitions, rather than converting the
+    # whole partition index.
+    active_partitions = np.asarray(active_partitions, dtype=np.int64)
+    starts = indices[active_partitions].astype(np.int64)
+    sizes = indices[active_partitions + 1].astype(np.int64) - starts
+    return np.cumsum(np.array([len(q) for q in active_queries], dtype=np.int64) * sizes)
+
+
+def node_ranges(
+    active_partitions: np.ndarray,
+    active_queries: List[List[int]],
+    indices: np.ndarray,
+    num_nodes: int,
+) -> np.ndarray:
+    """
+    Splits the active partitions into `num_nodes` contiguous ranges of similar work.
+
+    Returns the `num_nodes + 1` range boundaries, node `n` querying the active
+    partitions in `[bounds[n], bounds[n + 1])`. Nodes may get empty ranges, e.g.
+    when there are fewer active partitions than nodes.
+    """
+    # prefix[b] is the work of the first `b` active partitions.
+    prefix = np.concatenate(
+        ([0], cumulative_partition_work(active_partitions, active_queries, indices))
+    )
+    targets = prefix[-1] * np.arange(1, num_nodes) / num_nodes
+    # Cut at the partition boundary closest to each target.
+    upper = np.minimum(np.searchsorted(prefix, targets), len(prefix) - 1)
+    lower = np.maximum(upper - 1, 0)
+    bounds = np.where(targets - prefix[lower] < prefix[upper] - targets, lower, upper)
+    return np.concatenate(([0], bounds, [len(prefix) - 1])).astype(np.int64)
+
+
+def write_queries_array(
+    queries_t: np.ndarray,
+    scratch_uri: str,
+    config: Optional[Mapping[str, Any]] = None,
+) -> str:
+    """
+    Writes column-major (dimensions, nqueries) queries to a new array under
+    `scratch_uri`, stored as a single tile, and returns its URI.
+    """
+    queries_array_uri = f"{scratch_uri}/queries_{uuid.uuid4().hex}"
+    dimensions, nqueries = queries_t.shape
+    rows_dim = tiledb.Dim(
+        name="rows",
+        domain=(0, dimensions - 1),
+        tile=dimensions,
+        dtype=np.dtype(np.int32),
+    )
+    cols_dim = tiledb.Dim(
+        name="cols",
+        domain=(0, nqueries - 1),
+        tile=nqueries,
+        dtype=np.dtype(np.int32),
+    )
+    schema = tiledb.ArraySchema(
+        domain=tiledb.Domain(rows_dim, cols_dim),
+        sparse=False,
+        attrs=[tiledb.Attr(name="values", dtype=queries_t.dtype)],
+        cell_order="col-major",
+        tile_order="col-major",
+    )
+    with tiledb.scope_ctx(ctx_or_config=config):
+        tiledb.Array.create(queries_array_uri, schema)
+        try:
+            with tiledb.open(queries_array_uri, "w") as queries_array:
+                queries_array[:, :] = queries_t
+        except tiledb.TileDBError:
+            try:
+                tiledb.Array.delete_array(queries_array_uri)
+            except tiledb.TileDBError as e:
+                warnings.warn(
+                    f"Failed to delete the scratch queries array {queries_array_uri}: {e}"
+                )
+            raise
+    return queries_array_uri
+
+
+def read_queries(
+    query_vectors: Union[np.ndarray, str],
+    config: Optional[Mapping[str, Any]] = None,
+) -> np.ndarray:
+    """
+    Returns the column-major (dimensions, nqueries) queries passed to a taskgraph
+    node, either inline or as the URI of an array written by `write_queries_array`.
+    """
+    if isinstance(query_vectors, str):
+        with tiledb.open(query_vectors, "r", config=config) as queries_array:
+            return queries_array.query(attrs=("values",), order="F")[:]["values"]
+    return query_vectors
+
+
 class IVFFlatIndex(index.Index):
     """
     Opens an `IVFFlatIndex`.
@@ -67,7 +239,7 @@ class IVFFlatIndex(index.Index):
         If tuple, open at the given start and end timestamps.
     memory_budget: int
         Main memory budget, in number of vectors, for query execution.
-        If not provided, all index data are loaded in main memory.
+        If not provided, all index data are loaded in main memory on the first local query.
         Otherwise, no index data are loaded in main memory and this memory budget is
         applied during queries.
     """
@@ -82,24 +254,27 @@ class IVFFlatIndex(index.Index):
     ):
         self.index_type = INDEX_TYPE
         super().__init__(uri=uri, config=config, timestamp=timestamp)
+        storage_format = storage_formats[self.storage_version]
         self.db_uri = self.group[
-            storage_formats[self.storage_version]["PARTS_ARRAY_NAME"]
-            + self.index_version
+            storage_format["PARTS_ARRAY_NAME"] + self.index_version
         ].uri
         self.centroids_uri = self.group[
-            storage_formats[self.storage_version]["CENTROIDS_ARRAY_NAME"]
-            + self.index_version
+            storage_format["CENTROIDS_ARRAY_NAME"] + self.index_version
         ].uri
         self.index_array_uri = self.group[
-            storage_formats[self.storage_version]["INDEX_ARRAY_NAME"]
-            + self.index_version
+            storage_format["INDEX_ARRAY_NAME"] + self.index_version
         ].uri
         self.ids_uri = self.group[
-            storage_formats[self.storage_version]["IDS_ARRAY_NAME"] + self.index_version
+            storage_format["IDS_ARRAY_NAME"] + self.index_version
         ].uri
         self.memory_budget = memory_budget
+        self._centroids_cache = None
+        self._db_cache = None
+        self._ids_cache = None
 
-        schema = tiledb.ArraySchema.load(self.db_uri, ctx=tiledb.Ctx(self.config))
+        # Reuse a single tiledb.Ctx for all of the schema loads below.
+        tiledb_ctx = tiledb.Ctx(self.config)
+        schema = tiledb.ArraySchema.load(self.db_uri, ctx=tiledb_ctx)
         self.dimensions = schema.shape[0]
 
         self.dtype = self.group.meta.get("dtype", None)
@@ -118,20 +293,11 @@ class IVFFlatIndex(index.Index):
             for x in list(json.loads(self.group.meta.get("partition_history", "[]")))
         ]
         if len(self.partition_history) == 0:
-            schema = tiledb.ArraySchema.load(
-                self.centroids_uri, ctx=tiledb.Ctx(self.config)
-            )
+            schema = tiledb.ArraySchema.load(self.centroids_uri, ctx=tiledb_ctx)
             self.partitions = schema.domain.dim("cols").domain[1] + 1
         else:
             self.partitions = self.partition_history[self.history_index]
 
-        self._centroids = load_as_matrix(
-            self.centroids_uri,
-            ctx=self.ctx,
-            size=self.partitions,
-            config=config,
-            timestamp=self.base_array_timestamp,
-        )
         self._index = read_vector_u64(
             self.ctx,
             self.index_array_uri,
@@ -145,18 +311,50 @@ class IVFFlatIndex(index.Index):
         else:
             self.size = self.base_size
 
-        # TODO pass in a context
-        if self.memory_budget == -1:
-            self._db = load_as_matrix(
+    @property
+    def _centroids(self):
+        """
+        Partition centroids, loaded in main memory on first access.
+        """
+        if self._centroids_cache is None:
+            self._centroids_cache = load_as_matrix(
+                self.centroids_uri,
+                ctx=self.ctx,
+                size=self.partitions,
+                config=self.config,
+                timestamp=self.base_array_timestamp,
+            )
+        return self._centroids_cache
+
+    @property
+    def _db(self):
+        """
+        Partitioned vectors, loaded in main memory on first access.
+        """
+        if self._db_cache is None:
+            self._db_cache = load_as_matrix(
                 self.db_uri,
                 ctx=self.ctx,
-                config=config,
+                config=self.config,
                 size=self.size,
                 timestamp=self.base_array_timestamp,
             )
-            self._ids = read_vector_u64(
+        return self._db_cache
+
+    @property
+    def _ids(self):
+        """
+        Shuffled vector IDs, loaded in main memory on first access.
+
+        The in-RAM query kernels look up ids by shuffled vector position across all of
+        `_db`, so the whole vector is read. Queries with a `memory_budget` read only
+        the ids of the partitions they probe.
+        """
+        if self._ids_cache is None:
+            self._ids_cache = read_vector_u64(
                 self.ctx, self.ids_uri, 0, self.size, self.base_array_timestamp
             )
+        return self._ids_cache
 
     def get_dimensions(self):
         """
@@ -176,6 +374,7 @@ class IVFFlatIndex(index.Index):
         resources: Optional[Mapping[str, Any]] = None,
         num_partitions: int = -1,
         num_workers: int = -1,
+        scratch_uri: Optional[str] = None,
         **kwargs,
     ):
         """
@@ -210,10 +409,18 @@ class IVFFlatIndex(index.Index):
             in BATCH mode. Cannot be used alongside resource_class.
         num_partitions: int
             Only relevant for taskgraph based execution.
-            If provided, we split the query execution in that many partitions.
+            If provided, we split the query execution in at most that many partitions.
+            Fewer partitions are used when there is too little work to fill them, i.e.
+            about one per `MIN_NODE_WORK` query-vector distance computations.
         num_workers: int
             Only relevant for taskgraph based execution.
             If provided, this is the number of workers to use for the query execution.
+        scratch_uri: Optional[str]
+            Only relevant for REALTIME or BATCH mode.
+            If provided, large query batches are written to a temporary array under this
+            URI and read by the workers, instead of being sent inline to every node.
+            The array is deleted when the query completes. Raises if the array cannot
+            be written.
         """
         if self.size == 0:
             return np.full((queries.shape[0], k), MAX_FLOAT32), np.full(
@@ -224,18 +431,15 @@ class IVFFlatIndex(index.Index):
             raise TypeError("Can only pass resources in BATCH mode")
         if (mode != Mode.REALTIME and mode != Mode.BATCH) and resource_class:
             raise TypeError("Can only pass resource_class in REALTIME or BATCH mode")
-
-        assert queries.dtype == np.float32
-
-        if queries.ndim == 1:
-            queries = np.array([queries])
+        if queries.shape[0] == 0:
+            return np.empty((0, k), dtype=np.float32), np.empty((0, k), dtype=np.uint64)
 
         if nthreads == -1:
             nthreads = multiprocessing.cpu_count()
 
         nprobe = min(nprobe, self.partitions)
         if mode is None:
-            queries_m = array_to_matrix(np.transpose(queries))
+            queries_m = array_to_matrix(to_column_major(queries))
             if self.memory_budget == -1:
                 d, i = ivf_query_ram(
                     self.dtype,
@@ -267,7 +471,9 @@ class IVFFlatIndex(index.Index):
                     timestamp=self.base_array_timestamp,
                 )
 
-            return np.transpose(np.array(d)), np.transpose(np.array(i))
+            # The results are column-major (k, nqueries) matrices, so the transpose of
+            # a view on them is a row-major (nqueries, k) array and no copy is needed.
+            return np.transpose(np.asarray(d)), np.transpose(np.asarray(i))
         else:
             return self._taskgraph_query(
                 queries=queries,
@@ -279,6 +485,7 @@ class IVFFlatIndex(index.Index):
                 resources=resources,
                 num_partitions=num_partitions,
                 num_workers=num_workers,
+                scratch_uri=scratch_uri,
                 config=self.config,
             )
 
@@ -293,6 +500,7 @@ class IVFFlatIndex(index.Index):
         resources: Optional[Mapping[str, Any]] = None,
         num_partitions: int = -1,
         num_workers: int = -1,
+        scratch_uri: Optional[str] = None,
         config: Optional[Mapping[str, Any]] = None,
     ):
         """
@@ -324,40 +532,95 @@ class IVFFlatIndex(index.Index):
             in BATCH mode. Cannot be used alongside resource_class.
         num_partitions: int
             Only relevant for taskgraph based execution.
-            If provided, we split the query execution in that many partitions.
+            If provided, we split the query execution in at most that many partitions.
+            Fewer partitions are used when there is too little work to fill them, i.e.
+            about one per `MIN_NODE_WORK` query-vector distance computations.
         num_workers: int
             Only relevant for taskgraph based execution.
             If provided, this is the number of workers to use for the query execution.
+        scratch_uri: Optional[str]
+            Only relevant for REALTIME or BATCH mode.
+            If provided, large query batches are written to a temporary array under this
+            URI and read by the workers, instead of being sent inline to every node.
+            The array is deleted when the query completes. Raises if the array cannot
+            be written.
         config: None
             config dictionary, defaults to None
         """
-        import math
         from functools import partial
 
         import numpy as np
 
+        import tiledb
         from tiledb.cloud import dag
         from tiledb.cloud.dag import Mode
         from tiledb.vector_search.module import array_to_matrix
         from tiledb.vector_search.module import dist_qv
+        from tiledb.vector_search.module import load_as_matrix
         from tiledb.vector_search.module import partition_ivf_index
 
         if resource_class and resources:
             raise TypeError("Cannot provide both resource_class and resources")
 
+        # NOTE: The UDFs below are serialized and shipped to the taskgraph workers.
+        # They must only reference index arrays by URI and never capture `self` or
+        # its in-memory matrices (e.g. `self._centroids`), which would be pickled
+        # into every node.
+        def partition_udf(
+            centroids_uri: str,
+            query_vectors: Union[np.ndarray, str],
+            nprobe: int,
+            nthreads: int,
+            partitions: int,
+            config: Optional[Mapping[str, Any]] = None,
+            timestamp: int = 0,
+        ):
+            query_vectors = read_queries(query_vectors, config)
+            centroids = load_as_matrix(
+                centroids_uri,
+                config=config,
+                size=partitions,
+                timestamp=timestamp,
+            )
+            active_partitions, active_queries = partition_ivf_index(
+                centroids=centroids,
+                query=array_to_matrix(query_vectors),
+                nprobe=nprobe,
+                nthreads=nthreads,
+            )
+            return np.asarray(active_partitions, dtype=np.uint64), active_queries
+
         def dist_qv_udf(
             dtype: np.dtype,
             parts_uri: str,
             ids_uri: str,
-            query_vectors: np.ndarray,
-            active_partitions: np.array,
-            active_queries: np.array,
+            query_vectors: Union[np.ndarray, str],
+            partitioning: Tuple[np.array, List[List[int]]],
+            node_id: int,
+            num_nodes: int,
             indices: np.array,
             k_nn: int,
             config: Optional[Mapping[str, Any]] = None,
             timestamp: int = 0,
         ):
-            queries_m = array_to_matrix(np.transpose(query_vectors))
+            # query_vectors are already column-major (dimensions, nqueries).
+            # Empty result slots are padded with +inf distances.
+            query_vectors = read_queries(query_vectors, config)
+            results_d = np.full(
+                (query_vectors.shape[1], k_nn), np.inf, dtype=np.float32
+            )
+            results_i = np.zeros((query_vectors.shape[1], k_nn), dtype=np.uint64)
+
+            # Each node queries its own contiguous range of the active partitions.
+            active_partitions, active_queries = partitioning
+            bounds = node_ranges(active_partitions, active_queries, indices, num_nodes)
+            part, part_end = bounds[node_id], bounds[node_id + 1]
+            if part == part_end:
+                return results_d, results_i
+            active_partitions = active_partitions[part:part_end]
+            active_queries = active_queries[part:part_end]
+
+            queries_m = array_to_matrix(query_vectors)
             if timestamp == 0:
                 r = dist_qv(
                     dtype=dtype,
@@ -383,19 +646,90 @@ class IVFFlatIndex(index.Index):
                     ctx=Ctx(config),
                     timestamp=timestamp,
                 )
-            results = []
+            # Return dense (nqueries, k_nn) matrices instead of nested lists of
+            # tuples, so that the driver can merge them with NumPy.
             for q in range(len(r)):
-                tmp_results = []
-                for j in range(len(r[q])):
-                    tmp_results.append(r[q][j])
-                results.append(tmp_results)
-            return results
-
-        assert queries.dtype == np.float32
+                heap = r[q]
+                n = len(heap)
+                if n > 0:
+                    # Reading the heap is still one pybind call per result, but the
+                    # NumPy stores are done once per row.
+                    scores, ids = zip(*[heap[j] for j in range(n)])
+                    results_d[q, :n] = scores
+                    results_i[q, :n] = ids
+            return results_d, results_i
+
+        if queries.shape[0] == 0:
+            return np.empty((0, k), dtype=np.float32), np.empty((0, k), dtype=np.uint64)
         if num_partitions == -1:
             num_partitions = 5
         if num_workers == -1:
             num_workers = num_partitions
+        if not resources and not resource_class:
+            resource_class = "large"
+
+        # Compute the column-major queries once and share them with all nodes.
+        queries_t = to_column_major(queries)
+        idx_arr = np.asarray(self._index)
+        # Partitioning compares every query with every centroid. Only run it on a
+        # worker for large batches, as it delays all the dist_qv nodes.
+        partition_remotely = (mode == Mode.BATCH or mode == Mode.REALTIME) and (
+            queries.shape[0] * self.partitions * self.dimensions
+            > REMOTE_PARTITIONING_MIN_WORK
+        )
+        if partition_remotely:
+            # Size the DAG with what the client knows before partitioning: at most
+            # one node per probed partition, and roughly MIN_NODE_WORK distance
+            # computations per node for partitions of average size.
+            estimated_work = queries.shape[0] * nprobe * self.size / self.partitions
+            num_nodes = min(
+                num_partitions,
+                self.partitions,
+                queries.shape[0] * nprobe,
+                max(1, int(estimated_work) // MIN_NODE_WORK),
+            )
+        else:
+            active_partitions, active_queries = partition_ivf_index(
+                centroids=self._centroids,
+                query=array_to_matrix(queries_t),
+                nprobe=nprobe,
+                nthreads=nthreads,
+            )
+            active_partitions = np.asarray(active_partitions)
+            # Only split the work in as many nodes as it is worth.
+            total_work = cumulative_partition_work(
+                active_partitions, active_queries, idx_arr
+            )[-1]
+            num_nodes = min(
+                num_partitions,
+                len(active_partitions),
+                max(1, int(total_work) // MIN_NODE_WORK),
+            )
+            # Send each node only its own range of the active partitions.
+            bounds = node_ranges(active_partitions, active_queries, idx_arr, num_nodes)
+            node_partitionings = [
+                (
+                    active_partitions[bounds[node_id] : bounds[node_id + 1]],
+                    active_queries[bounds[node_id] : bounds[node_id + 1]],
+                )
+                for node_id in range(num_nodes)
+            ]
+            if num_nodes == 1 and mode != Mode.BATCH and mode != Mode.REALTIME:
+                results_d, results_i = dist_qv_udf(
+                    dtype=self.dtype,
+                    parts_uri=self.db_uri,
+                    ids_uri=self.ids_uri,
+                    query_vectors=queries_t,
+                    partitioning=node_partitionings[0],
+                    node_id=0,
+                    num_nodes=1,
+                    indices=idx_arr,
+                    k_nn=k,
+                    config=config,
+                    timestamp=self.base_array_timestamp,
+                )
+                return merge_top_k(results_d, results_i, k)
+
         if mode == Mode.BATCH:
             d = dag.DAG(
                 name="vector-query",
@@ -416,70 +750,93 @@ class IVFFlatIndex(index.Index):
                 namespace="default",
             )
         submit = partial(submit_local, d)
+        query_vectors = queries_t
+        queries_array_uri = None
         if mode == Mode.BATCH or mode == Mode.REALTIME:
             submit = d.submit
-
-        queries_m = array_to_matrix(np.transpose(queries))
-        active_partitions, active_queries = partition_ivf_index(
-            centroids=self._centroids, query=queries_m, nprobe=nprobe, nthreads=nthreads
-        )
-        num_parts = len(active_partitions)
-
-        parts_per_node = int(math.ceil(num_parts / num_partitions))
-        nodes = []
-        for part in range(0, num_parts, parts_per_node):
-            part_end = part + parts_per_node
-            if part_end > num_parts:
-                part_end = num_parts
-            aq = []
-            for tt in range(part, part_end):
-                aqt = []
-                for ttt in range(len(active_queries[tt])):
-                    aqt.append(active_queries[tt][ttt])
-                aq.append(aqt)
-            nodes.append(
-                submit(
-                    dist_qv_udf,
-                    dtype=self.dtype,
-                    parts_uri=self.db_uri,
-                    ids_uri=self.ids_uri,
-                    query_vectors=queries,
-                    active_partitions=np.array(active_partitions)[part:part_end],
-                    active_queries=np.array(aq, dtype=object),
-                    indices=np.array(self._index),
-                    k_nn=k,
+            if scratch_uri is not None and queries_t.nbytes > QUERIES_ARRAY_MIN_BYTES:
+                queries_array_uri = write_queries_array(
+                    queries_t, scratch_uri, config=self.config
+                )
+                query_vectors = queries_array_uri
+
+        node_futures = []
+        try:
+            if partition_remotely:
+                # Partition the queries on a worker, so that the centroids are not
+                # read and scanned on the client.
+                partitioning = submit(
+                    partition_udf,
+                    centroids_uri=self.centroids_uri,
+                    query_vectors=query_vectors,
+                    nprobe=nprobe,
+                    nthreads=nthreads,
+                    partitions=self.partitions,
                     config=config,
                     timestamp=self.base_array_timestamp,
-                    resource_class="large"
-                    if (not resources and not resource_class)
-                    else resource_class,
+                    resource_class=resource_class,
                     resources=resources,
                     image_name="3.9-vectorsearch",
                 )
-            )
+                # Each node finds its own range of the partitioning result.
+                node_args = [
+                    (partitioning, node_id, num_nodes) for node_id in range(num_nodes)
+                ]
+            else:
+                node_args = [
+                    (node_partitioning, 0, 1)
+                    for node_partitioning in node_partitionings
+                ]
+
+            nodes = []
+            for node_partitioning, node_id, node_count in node_args:
+                nodes.append(
+                    submit(
+                        dist_qv_udf,
+                        dtype=self.dtype,
+                        parts_uri=self.db_uri,
+                        ids_uri=self.ids_uri,
+                        query_vectors=query_vectors,
+                        partitioning=node_partitioning,
+                        node_id=node_id,
+                        num_nodes=node_count,
+                        indices=idx_arr,
+                        k_nn=k,
+                        config=config,
+                        timestamp=self.base_array_timestamp,
+                        resource_class=resource_class,
+                        resources=resources,
+                        image_name="3.9-vectorsearch",
+                    )
+                )
 
-        d.compute()
-        d.wait()
-        results = []
-        for node in nodes:
-            res = node.result()
-            results.append(res)
-
-        results_per_query_d = []
-        results_per_query_i = []
-        for q in range(queries.shape[0]):
-            tmp_results = []
-            for j in range(k):
-                for r in results:
-                    if len(r[q]) > j:
-                        if r[q][j][0] > 0:
-                            tmp_results.append(r[q][j])
-            tmp = sorted(tmp_results, key=lambda t: t[0])[0:k]
-            for j in range(len(tmp), k):
-                tmp.append((float(0.0), int(0)))
-            results_per_query_d.append(np.array(tmp, dtype=np.float32)[:, 0])
-            results_per_query_i.append(np.array(tmp, dtype=np.uint64)[:, 1])
-        return np.array(results_per_query_d), np.array(results_per_query_i)
+            d.compute()
+            # Merge each node's results as soon as it completes, so that merging
+            # overlaps with waiting on the slowest nodes. The running top-k is kept in
+            # the first k columns of the buffer and the incoming node results in the
+            # last k.
+            results_d = np.zeros((queries.shape[0], 2 * k), dtype=np.float32)
+            results_i = np.zeros((queries.shape[0], 2 * k), dtype=np.uint64)
+            top_d, top_i = results_d[:, :k], results_i[:, :k]
+            node_futures = [self.thread_executor.submit(node.result) for node in nodes]
+            for future in _completion_order(node_futures):
+                results_d[:, :k], results_i[:, :k] = top_d, top_i
+                results_d[:, k:], results_i[:, k:] = future.result()
+                top_d, top_i = merge_top_k(results_d, results_i, k)
+        finally:
+            if queries_array_uri is not None:
+                # Only delete the queries once no node can still be reading them.
+                futures.wait(node_futures)
+                try:
+                    tiledb.Array.delete_array(
+                        queries_array_uri, ctx=tiledb.Ctx(self.config)
+                    )
+                except tiledb.TileDBError as e:
+                    # Do not hide the error of the query itself, if any.
+                    warnings.warn(
+                        f"Failed to delete the scratch queries array {queries_array_uri}: {e}"
+                    )
+        return top_d, top_i
 
 
 def create(
@@ -7,6 +7,7 @@ from array_paths import *
 from common import *
 from common import load_metadata
 
+from tiledb.cloud.dag import Mode
 from tiledb.vector_search import Index
 from tiledb.vector_search import flat_index
 from tiledb.vector_search import ivf_flat_index
@@ -16,6 +17,8 @@ from tiledb.vector_search.index import DATASET_TYPE
 from tiledb.vector_search.index import create_metadata
 from tiledb.vector_search.ingestion import ingest
 from tiledb.vector_search.ivf_flat_index import IVFFlatIndex
+from tiledb.vector_search.module import array_to_matrix
+from tiledb.vector_search.module import partition_ivf_index
 from tiledb.vector_search.utils import MAX_FLOAT32
 from tiledb.vector_search.utils import MAX_UINT64
 from tiledb.vector_search.utils import is_type_erased_index
@@ -214,6 +217,198 @@ def test_ivf_flat_index(tmp_path):
     assert vfs.dir_size(uri) == 0
 
 
+def test_ivf_flat_merge_top_k():
+    # Two nodes with k=3 results each. Distances <= 0 are empty slots.
+    results_d = np.array(
+        [[3, 1, 0, 2, 4, 0], [0, 0, 0, 5, 0, 0]],
+        dtype=np.float32,
+    )
+    results_i = np.array(
+        [[3, 1, 0, 2, 4, 0], [0, 0, 0, 5, 0, 0]],
+        dtype=np.uint64,
+    )
+    distances, ids = ivf_flat_index.merge_top_k(results_d, results_i, 3)
+    assert np.array_equal(distances, np.array([[1, 2, 3], [5, 0, 0]]))
+    assert np.array_equal(ids, np.array([[1, 2, 3], [5, 0, 0]]))
+    assert distances.dtype == np.float32
+    assert ids.dtype == np.uint64
+
+
+def test_ivf_flat_queries_array(tmp_path):
+    queries = np.random.default_rng(0).random((7, 3), dtype=np.float32)
+    queries_t = ivf_flat_index.to_column_major(queries)
+    queries_array_uri = ivf_flat_index.write_queries_array(queries_t, str(tmp_path))
+    assert queries_array_uri.startswith(str(tmp_path))
+
+    # Workers read back the same column-major (dimensions, nqueries) queries.
+    read_queries_t = ivf_flat_index.read_queries(queries_array_uri)
+    assert read_queries_t.shape == (3, 7)
+    assert read_queries_t.dtype == np.float32
+    assert read_queries_t.flags.f_contiguous
+    assert np.array_equal(read_queries_t, queries_t)
+
+    # Queries passed inline are returned as is.
+    assert ivf_flat_index.read_queries(queries_t) is queries_t
+
+    # Failing to write the queries raises instead of silently sending them inline.
+    not_a_directory = os.path.join(tmp_path, "file")
+    open(not_a_directory, "w").close()
+    with pytest.raises(tiledb.TileDBError):
+        ivf_flat_index.write_queries_array(queries_t, not_a_directory)
+
+
+def test_ivf_flat_node_ranges():
+    # Partitions 0, 1 and 2 have 2, 0 and 3 vectors.
+    indices = np.array([0, 2, 2, 5], dtype=np.uint64)
+    active_partitions = np.array([0, 2], dtype=np.uint64)
+    active_queries = [[0], [0, 1]]
+    work = ivf_flat_index.cumulative_partition_work(
+        active_partitions, active_queries, indices
+    )
+    assert np.array_equal(work, [2, 8])
+
+    # Each node gets a contiguous range and together they cover all partitions.
+    bounds = ivf_flat_index.node_ranges(active_partitions, active_queries, indices, 2)
+    assert np.array_equal(bounds, [0, 1, 2])
+
+    # More nodes than active partitions leaves the extra nodes with empty ranges.
+    bounds = ivf_flat_index.node_ranges(active_partitions, active_queries, indices, 4)
+    assert bounds[0] == 0 and bounds[-1] == 2
+    assert np.all(np.diff(bounds) >= 0)
+    assert np.count_nonzero(np.diff(bounds)) == 2
+
+    # Zero total work, e.g. only empty partitions are probed.
+    bounds = ivf_flat_index.node_ranges(np.array([1]), [[0, 1]], indices, 3)
+    assert bounds[0] == 0 and bounds[-1] == 1
+    assert np.all(np.diff(bounds) >= 0)
+
+    # No active partitions.
+    bounds = ivf_flat_index.node_ranges(np.array([], dtype=np.uint64), [], indices, 3)
+    assert np.array_equal(bounds, [0, 0, 0, 0])
+
+    # A partition much larger than the others is not split across nodes.
+    indices = np.array([0, 1000, 1001, 1002, 1003], dtype=np.uint64)
+    active_partitions = np.array([0, 1, 2, 3], dtype=np.uint64)
+    active_queries = [[0], [0], [0], [0]]
+    bounds = ivf_flat_index.node_ranges(active_partitions, active_queries, indices, 3)
+    assert np.array_equal(bounds, [0, 0, 1, 4])
+    indices = np.array([0, 1, 2, 3, 1003], dtype=np.uint64)
+    bounds = ivf_flat_index.node_ranges(active_partitions, active_queries, indices, 3)
+    assert np.array_equal(bounds, [0, 3, 4, 4])
+
+
+def test_ivf_flat_index_local_multiple_nodes(tmp_path, monkeypatch):
+    # Split even small queries across the taskgraph nodes.
+    monkeypatch.setattr(ivf_flat_index, "MIN_NODE_WORK", 1)
+    uri = os.path.join(tmp_path, "array")
+    data = np.random.default_rng(0).random((1000, 3), dtype=np.float32)
+    index = ingest(
+        index_type="IVF_FLAT", index_uri=uri, input_vectors=data, partitions=10
+    )
+    queries = data[:20] + 0.01
+    expected_d, expected_i = index.query(queries, k=10, nprobe=3)
+    d, i = index.query(queries, k=10, nprobe=3, mode=Mode.LOCAL, num_partitions=2)
+    assert np.array_equal(i, expected_i)
+    assert np.allclose(d, expected_d)
+
+
+def test_ivf_flat_index_local_uneven_nodes(tmp_path, monkeypatch):
+    monkeypatch.setattr(ivf_flat_index, "MIN_NODE_WORK", 1)
+    # One large partition around the centroid at 0 and three small ones.
+    rng = np.random.default_rng(0)
+    dimensions = 3
+    centroids = np.array([[0] * 3, [100] * 3, [200] * 3, [300] * 3], dtype=np.float32)
+    data = np.vstack(
+        [rng.random((200, dimensions), dtype=np.float32)]
+        + [c + rng.random((3, dimensions), dtype=np.float32) for c in centroids[1:]]
+    )
+    centroids_uri = os.path.join(tmp_path, "centroids")
+    tiledb.from_numpy(centroids_uri, np.transpose(centroids))
+    uri = os.path.join(tmp_path, "array")
+    index = ingest(
+        index_type="IVF_FLAT",
+        index_uri=uri,
+        input_vectors=data,
+        partitions=len(centroids),
+        copy_centroids_uri=centroids_uri,
+    )
+    queries = np.vstack([c + 0.5 for c in centroids])
+    nprobe = len(centroids)
+    num_nodes = 4
+
+    # Some nodes get no partitions, as the large one outweighs all the others.
+    active_partitions, active_queries = partition_ivf_index(
+        centroids=index._centroids,
+        query=array_to_matrix(ivf_flat_index.to_column_major(queries)),
+        nprobe=nprobe,
+        nthreads=1,
+    )
+    bounds = ivf_flat_index.node_ranges(
+        np.asarray(active_partitions),
+        active_queries,
+        np.asarray(index._index),
+        num_nodes,
+    )
+    assert np.count_nonzero(np.diff(bounds) == 0) > 0
+
+    expected_d, expected_i = index.query(queries, k=3, nprobe=nprobe)
+
+    def reversed_order(fs):
+        return reversed(list(fs))
+
+    # Merge the node results in completion order and in reverse submission order.
+    for merge_order in [ivf_flat_index._completion_order, reversed_order]:
+        monkeypatch.setattr(ivf_flat_index, "_completion_order", merge_order)
+        d, i = index.query(
+            queries, k=3, nprobe=nprobe, mode=Mode.LOCAL, num_partitions=num_nodes
+        )
+        assert np.array_equal(i, expected_i)
+        assert np.allclose(d, expected_d)
+
+
+def test_ivf_flat_index_query_conversion(tmp_path):
+    uri = os.path.join(tmp_path, "array")
+    data = np.array(
+        [[0, 0, 0], [1, 1, 1], [2, 2, 2], [3, 3, 3], [4, 4, 4]], dtype=np.float32
+    )
+    index = ingest(index_type="IVF_FLAT", index_uri=uri, input_vectors=data)
+    queries = np.array([[1.1, 1.1, 1.1], [3.1, 3.1, 3.1]], dtype=np.float32)
+    expected_d, expected_i = index.query(queries, k=2, nprobe=index.partitions)
+    assert expected_d.dtype == np.float32
+    assert expected_i.dtype == np.uint64
+
+    # float64 and non C-contiguous queries are converted to float32.
+    for converted in [queries.astype(np.float64), np.asfortranarray(queries)]:
+        d, i = index.query(converted, k=2, nprobe=index.partitions)
+        assert np.array_equal(i, expected_i)
+        assert np.array_equal(d, expected_d)
+
+    # An empty batch returns empty results.
+    d, i = index.query(np.empty((0, 3), dtype=np.float32), k=2)
+    assert d.shape == (0, 2) and d.dtype == np.float32
+    assert i.shape == (0, 2) and i.dtype == np.uint64
+
+    # Invalid arguments are still rejected for an empty batch.
+    with pytest.raises(TypeError):
+        index.query(
+            np.empty((0, 3), dtype=np.float32),
+            k=2,
+            mode=Mode.LOCAL,
+            resource_class="large",
+        )
+
+    # float64 queries are also converted before querying the updates.
+    update_vectors = np.empty([1], dtype=object)
+    update_vectors[0] = np.array([1.3, 1.3, 1.3], dtype=np.float32)
+    index.update_batch(vectors=update_vectors, external_ids=np.array([5]))
+    queries = np.array([[1.25, 1.25, 1.25], [3.1, 3.1, 3.1]], dtype=np.float32)
+    expected_d, expected_i = index.query(queries, k=2, nprobe=index.partitions)
+    assert np.array_equal(expected_i[0], [5, 1])
+    d, i = index.query(queries.astype(np.float64), k=2, nprobe=index.partitions)
+    assert np.array_equal(i, expected_i)
+    assert np.array_equal(d, expected_d)
+
+
 def test_vamana_index_simple(tmp_path):
     uri = os.path.join(tmp_path, "array")
     dimensions = 3